@@ -1,19 +1,26 @@
 import os
+import re
 import argparse
 import datetime
+import shutil
 
 import pandas as pd
 import numpy as np
 
 from . import hgmd
-from . import visualize as vis
 from . import quads
 import sys
 import multiprocessing
+from multiprocessing import shared_memory
 import time
 import math
-import matplotlib.pyplot as plt
-import random
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather
+    from pyarrow import csv as pacsv
+except ImportError:
+    pacsv = None
 #from docs.source import conf
 
 
@@ -67,89 +74,204 @@ def init_parser(parser):
         '-Trim', nargs='?',default=2000,
         help="Trim output files"
     )
+    parser.add_argument(
+        '-FastIO', action='store_true',
+        help="Write output CSVs with pyarrow (faster, not byte-identical)"
+    )
     return parser
 
 
-def read_data(cls_path, tsne_path, marker_path, gene_path, D):
+def write_csv(frame, path, fast_io):
     """
-    Reads in cluster series, tsne data, marker expression without complements
-    at given paths.
+    Writes frame, index included, to CSV at path.
+
+    With fast_io (and pyarrow installed) the buffered pyarrow CSV writer is
+    used in place of DataFrame.to_csv. Values are the same, but quoting and
+    float formatting differ, and an unnamed index is headed 'index'.
     """
-    
-    cls_ser = pd.read_csv(
-        cls_path, sep='\t', index_col=0, names=['cell', 'cluster'], squeeze=True
-    )
+    if fast_io and pacsv is not None:
+        pacsv.write_csv(
+            pa.Table.from_pandas(frame.reset_index(), preserve_index=False),
+            path
+        )
+    else:
+        frame.to_csv(path)
 
-    tsne = pd.read_csv(
-        tsne_path, sep='\t', index_col=0, names=['cell', 'tSNE_1', 'tSNE_2']
-    )
-    #could be optimized to read and check against gene list simultaneously
-    #if this is being a bottleneck. Would require unboxing pd.read_csv though.
-    start_= time.time()
-    no_complement_marker_exp = pd.read_csv(
-        marker_path,sep='\t', index_col=0
-        ).rename_axis('cell',axis=1)
 
-    if no_complement_marker_exp.shape[1] == cls_ser.shape[0]:
+def fresh_cache(path):
+    """
+    Returns the Feather cache path for path, or None if there is no cache
+    newer than path (or pyarrow is not installed).
+    """
+    if pacsv is None:
+        return None
+    cache = path + '.feather'
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return cache
+    return None
+
+
+def read_cached(path, reader):
+    """
+    Reads a DataFrame from path with reader, caching it as Feather.
+
+    The cache is written next to the input as <path>.feather and is used in
+    place of reader on later runs as long as it is newer than the input.
+    Caching is skipped when pyarrow is not installed.
+    """
+    if pacsv is None:
+        return reader(path)
+    cache = fresh_cache(path)
+    if cache is not None:
+        frame = pd.read_feather(cache)
+        return frame.set_index(frame.columns[0])
+    frame = reader(path)
+    try:
+        frame.reset_index().to_feather(path + '.feather')
+    except (OSError, TypeError, ValueError):
+        #read only input directory or labels feather can't store
         pass
+    return frame
+
+
+def read_marker_exp(marker_path, genes=None):
+    """
+    Reads in the tab separated gene by cell marker expression matrix.
+
+    Uses the multithreaded pyarrow CSV reader when pyarrow is installed,
+    otherwise falls back to the pandas C parser. If genes (a set of upper
+    case gene names) is given, only those gene rows are kept. Rows of other
+    genes are never converted to pandas, and with the pandas parser never
+    tokenized. The pyarrow reader still parses them, so it caches the full
+    matrix as Feather (see read_cached) for the next run.
+
+    Expression values are parsed straight to float32, so no float64 copy of
+    the matrix is made; the 1e-3 precision COMET compares expression at (see
+    hgmd.FLOAT_PRECISION) is well within it.
+    """
+    #cell ids from the header, to give every value column a float32 dtype.
+    #A header one field shorter than the rows (R's write.table default) has
+    #no name for the gene column; pandas infers it, pyarrow must be told.
+    with open(marker_path, 'r') as header:
+        cells = header.readline().rstrip('\r\n').split('\t')
+        first_row = header.readline().rstrip('\r\n').split('\t')
+    short_header = len(cells) == len(first_row) - 1
+    if not short_header:
+        cells = cells[1:]
+    pd_dtype = {cell: np.float32 for cell in cells}
+    if pacsv is not None:
+        if short_header:
+            read_opts = pacsv.ReadOptions(
+                column_names=[''] + cells, skip_rows=1
+            )
+        else:
+            read_opts = pacsv.ReadOptions()
+        read_options = dict(
+            read_options=read_opts,
+            parse_options=pacsv.ParseOptions(delimiter='\t'),
+            convert_options=pacsv.ConvertOptions(
+                column_types={cell: pa.float32() for cell in cells}
+            )
+        )
+
+    def parse(path):
+        if pacsv is None:
+            return pd.read_csv(
+                path, sep='\t', index_col=0, engine='c', memory_map=True,
+                dtype=pd_dtype
+            )
+        tbl = pacsv.read_csv(path, **read_options)
+        return tbl.to_pandas().set_index(tbl.column_names[0])
+
+    def parse_genes(path):
+        if pacsv is None:
+            names = pd.read_csv(
+                path, sep='\t', usecols=[0], engine='c', header=None,
+                skiprows=1
+            ).iloc[:, 0]
+            skip = [
+                row + 1 for row, name in enumerate(names)
+                if str(name).upper() not in genes
+            ]
+            return pd.read_csv(
+                path, sep='\t', index_col=0, engine='c', skiprows=skip,
+                dtype=pd_dtype
+            )
+        tbl = pacsv.read_csv(path, **read_options)
+        #every row has been parsed anyway, so cache the full matrix for
+        #later runs before filtering it
+        try:
+            pa.feather.write_feather(tbl, path + '.feather')
+        except (OSError, TypeError, ValueError):
+            pass
+        names = pc.utf8_upper(tbl.column(0).cast(pa.string()))
+        tbl = tbl.filter(pc.is_in(names, value_set=pa.array(sorted(genes))))
+        return tbl.to_pandas().set_index(tbl.column_names[0])
+
+    if genes is None:
+        marker_exp = read_cached(marker_path, parse)
+    elif fresh_cache(marker_path) is not None:
+        marker_exp = read_cached(marker_path, parse)
+        marker_exp = marker_exp[marker_exp.index.astype(str).str.upper().isin(genes)]
     else:
-        for index,row in cls_ser.iteritems():
-            if str(index) in list(no_complement_marker_exp):
-                continue
-            else:
-                cls_ser.drop(labels=index,inplace=True)
+        marker_exp = parse_genes(marker_path)
+    marker_exp = marker_exp.astype(np.float32, copy=False)
+    return marker_exp.rename_axis(None).rename_axis('cell',axis=1)
+
+
+def read_data(cls_path, tsne_path, marker_path, gene_path, D):
+    """
+    Reads in cluster series, tsne data, marker expression without complements
+    at given paths.
+    """
     
-    #gene list filtering
-    no_complement_marker_exp = np.transpose(no_complement_marker_exp)
-    no_complement_marker_exp.columns = [x.upper() for x in no_complement_marker_exp.columns]
+    cls_ser = read_cached(cls_path, lambda path: pd.read_csv(
+        path, sep='\t', index_col=0, names=['cell', 'cluster']
+    ))['cluster']
+
+    tsne = read_cached(tsne_path, lambda path: pd.read_csv(
+        path, sep='\t', index_col=0, names=['cell', 'tSNE_1', 'tSNE_2'],
+        dtype={'tSNE_1': np.float32, 'tSNE_2': np.float32}
+    ))
     #gene filtering
     #-------------#
     if gene_path is None:
-        pass
+        master_gene_list = None
     else:
 
         #read the genes
         #Compatible with single line comma list OR one per line no commas OR mix of both
-        master_gene_list = []
+        #(any whitespace also separates genes)
         with open(gene_path, "r") as genes:
-            lines = genes.readlines()
-            if len(lines) == 1:
-                with open(gene_path, "r") as genes:
-                    init_read = genes.read().splitlines()
-                    master_str = str.upper(init_read[0])
-                    master_gene_list = master_str.split(",")
-            else:
-                for i, line in enumerate(lines):
-                    if '\n' in line:
-                        master_gene_list.append(line[:-1])
-                    else:
-                        master_gene_list.append(line)
-                for item in master_gene_list[:]:
-                    if ',' in item:
-                        new_split = item.split(",")
-                        master_gene_list.remove(item)
-                        for ele in new_split:
-                            master_gene_list.append(str.upper(ele))
+            master_gene_list = [
+                gene for gene in re.split(r'[,\s]+', genes.read().upper()) if gene
+            ]
 
-    
-        new_no_comp_mark_exp = pd.DataFrame()
-        for gene in master_gene_list:
-            try:
-                new_no_comp_mark_exp[gene] = no_complement_marker_exp[gene]
-            except:
-                pass
+    start_= time.time()
+    no_complement_marker_exp = read_marker_exp(
+        marker_path,
+        genes=None if master_gene_list is None else set(master_gene_list)
+    )
 
-        no_complement_marker_exp = new_no_comp_mark_exp
-        '''
-        for column_name in no_complement_marker_exp.columns:
-            if str.upper(column_name) in master_gene_list:
-                pass
-            else:
-                try:
-                    no_complement_marker_exp.drop(column_name, axis=1, inplace=True)
-                except:
-                    pass
-        '''
+    #throw out cells in cluster assignments that have no expression column
+    cls_ser = cls_ser[
+        cls_ser.index.astype(str).isin(no_complement_marker_exp.columns.astype(str))
+    ]
+    
+    #cells as rows; one contiguous copy of the float32 block rather than
+    #pandas' block-wise transpose
+    no_complement_marker_exp = pd.DataFrame(
+        no_complement_marker_exp.values.T.copy(order='C'),
+        index=no_complement_marker_exp.columns,
+        columns=no_complement_marker_exp.index
+    )
+    no_complement_marker_exp.columns = no_complement_marker_exp.columns.astype(str).str.upper()
+    if master_gene_list is not None:
+        #keep the gene list order
+        no_complement_marker_exp = no_complement_marker_exp[[
+            gene for gene in dict.fromkeys(master_gene_list)
+            if gene in no_complement_marker_exp.columns
+        ]]
     #-------------#
 
     #downsampling
@@ -175,38 +297,19 @@ def read_data(cls_path, tsne_path, marker_path, gene_path, D):
         if N <= M:
             return (cls_ser, tsne, no_complement_marker_exp, gene_path)
         clusters = sorted(cls_ser.unique())
-        counts = { x : 0 for x in clusters}
-        for clus in cls_ser:
-            counts[clus] = counts[clus]+1
+        counts = cls_ser.value_counts().to_dict()
         #at this point counts has values for # cells in cls
         #dict goes like ->{ cluster:#cells }
-        take_nums = {x : 0 for x in clusters}
-        for clstr in take_nums:
-            take_nums[clstr] = math.ceil(counts[clstr]*(M/N))
-        summ = 0
-        for key in take_nums:
-            summ = summ + take_nums[key]
-        #print('Downsampled cell num ' + str(summ))
-        counts= { x : 0 for x in clusters}
-        new_cls_ser = cls_ser.copy(deep=True)
-        keep_first = 0
-        for index,value in new_cls_ser.iteritems():
-            keep_first = keep_first + 1
-            if keep_first ==1:
-                counts[value] = counts[value]+1
-                continue
-            new_cls_ser.drop(index,inplace=True)
-        cls_ser.drop(cls_ser.index[0],inplace=True)
-        #Now new_cls_ser has all removed except first item, which we can keep
-        for num in range(N-1):
-            init_rand_num = random.randint(0,N-num-1-1)
-            if counts[cls_ser[init_rand_num]] >= take_nums[cls_ser[init_rand_num]]:
-                cls_ser.drop(cls_ser.index[init_rand_num], inplace=True)
-                continue
-            new_cls_ser = new_cls_ser.append(pd.Series([cls_ser[init_rand_num]], index=[cls_ser.index[init_rand_num]]))
-            counts[cls_ser[init_rand_num]] = counts[cls_ser[init_rand_num]]+1
-            cls_ser.drop(cls_ser.index[init_rand_num], inplace=True)
-            
+        take_nums = {
+            clstr : math.ceil(counts[clstr]*(M/N)) for clstr in clusters
+        }
+        #stratified sample: shuffle once with a fixed seed, then keep the
+        #first take_nums[cls] cells of each cluster
+        shuffled = cls_ser.iloc[np.random.default_rng(42).permutation(N)]
+        new_cls_ser = shuffled[
+            shuffled.groupby(shuffled).cumcount().values
+            < shuffled.map(take_nums).values
+        ]
         new_cls_ser.rename_axis('cell',inplace=True)
         new_cls_ser.rename('cluster', inplace=True)
         return(new_cls_ser,tsne,no_complement_marker_exp,gene_path)
@@ -217,18 +320,19 @@ def read_data(cls_path, tsne_path, marker_path, gene_path, D):
             
     return (cls_ser, tsne, no_complement_marker_exp, gene_path)
 
-def process(cls,X,L,plot_pages,cls_ser,tsne,marker_exp,gene_file,csv_path,vis_path,pickle_path,cluster_number,K,abbrev,cluster_overall,Trim):
+def process(cls,X,L,plot_pages,cls_ser,tsne,marker_exp,gene_file,csv_path,vis_path,pickle_path,cluster_number,K,abbrev,cluster_overall,Trim,fast_io=False,xlmhg=None,order=None):
     #for cls in clusters:
     # To understand the flow of this section, read the print statements.
     start_cls_time = time.time()
     print('########\n# Processing cluster ' + str(cls) + '...\n########')
     print(str(K) + ' gene combinations')
-    print('Running t test on singletons...')
-    t_test = hgmd.batch_stats(marker_exp, cls_ser, cls)
-    print('Calculating fold change')
-    fc_test = hgmd.batch_fold_change(marker_exp, cls_ser, cls)
-    print('Running XL-mHG on singletons...')
-    xlmhg = hgmd.batch_xlmhg(marker_exp, cls_ser, cls, X=X, L=L)
+    print('Running t test and calculating fold change on singletons...')
+    sing_stats = hgmd.singleton_stats(marker_exp, cls_ser, cls)
+    if xlmhg is None:
+        print('Running XL-mHG on singletons...')
+        xlmhg = hgmd.batch_xlmhg(
+            marker_exp, cls_ser, cls, X=X, L=L, order=order
+        )
     q_val = hgmd.batch_q(xlmhg)
     # We need to slide the cutoff indices before using them,
     # to be sure they can be used in the real world. See hgmd.mhg_slide()
@@ -248,14 +352,8 @@ def process(cls,X,L,plot_pages,cls_ser,tsne,marker_exp,gene_file,csv_path,vis_pa
     #ABBREVIATED 
     if len(abbrev) > 0:
         print('Heuristic Abbreviation initiated for ' + str(abbrev) )
-        count = 0
-        trips_list=[]
-        for index,row in xlmhg.iterrows():
-            if count == 150:
-                break
-            else:
-                trips_list.append(row[0])
-                count = count + 1
+        #150 best singletons by mHG_stat
+        trips_list = xlmhg['gene_1'].iloc[:150].tolist()
     else:
         trips_list = None
     ############
@@ -322,13 +420,10 @@ def process(cls,X,L,plot_pages,cls_ser,tsne,marker_exp,gene_file,csv_path,vis_pa
     HG_end = time.time()
     print(str(HG_end-HG_start) + ' seconds')
     
-    pair_out_initial = pair\
-    .sort_values(by='HG_pval', ascending=True)
-    
-    pair_out_initial['rank'] = pair_out_initial.reset_index().index + 1
-    pair_out_print = pair_out_initial.head(Trim)
-    pair_out_print.to_csv(
-    csv_path + '/cluster_' + str(cls) + '_pair_HG_stat_ranked.csv'
+    pair_out_print = hgmd.top_k_sorted(pair, 'HG_pval', Trim)
+    pair_out_print['rank'] = np.arange(1, len(pair_out_print) + 1)
+    write_csv(
+        pair_out_print, csv_path + '/cluster_' + str(cls) + '_pair_HG_stat_ranked.csv', fast_io
     )
     if K == 3:
         HG_start = time.time()
@@ -357,17 +452,6 @@ def process(cls,X,L,plot_pages,cls_ser,tsne,marker_exp,gene_file,csv_path,vis_pa
         gene_map, in_cls_count, pop_count,
         in_cls_product, total_product, upper_tri_indices, abbrev, revised_indices
     )
-    #accumulates pair TP/TN vals for all other clusters
-    ##NEW
-    other_pair_tp_tn = {}
-    for key in cluster_exp_matrices:
-        new_pair_tp_tn = hgmd.pair_tp_tn(
-            gene_map, cls_counts[key], pop_count,
-            cluster_exp_matrices[key], total_product, upper_tri_indices,
-            abbrev, revised_indices
-        )
-        other_pair_tp_tn[key] = new_pair_tp_tn
-        other_pair_tp_tn[key].set_index(['gene_1','gene_2'],inplace=True)
     pair = pair\
         .merge(pair_tp_tn, on=['gene_1', 'gene_2'], how='left')\
         .merge(pair_q, on=['gene_1','gene_2'], how='left')
@@ -375,7 +459,7 @@ def process(cls,X,L,plot_pages,cls_ser,tsne,marker_exp,gene_file,csv_path,vis_pa
     sing_tp_tn.set_index(['gene_1'], inplace=True)
     rank_start = time.time()
     print('Finding NEW Rank')
-    ranked_pair,histogram = hgmd.ranker(pair,xlmhg,sing_tp_tn,other_sing_tp_tn,other_pair_tp_tn,cls_counts,in_cls_count,pop_count)
+    ranked_pair,histogram = hgmd.ranker(pair,xlmhg,sing_tp_tn,other_sing_tp_tn,gene_map,cluster_exp_matrices,total_product,cls_counts,in_cls_count,pop_count)
     rank_end = time.time()
     print(str(rank_end - rank_start) + ' seconds')
     # Save TP/TN values to be used for non-cluster-specific things
@@ -385,31 +469,33 @@ def process(cls,X,L,plot_pages,cls_ser,tsne,marker_exp,gene_file,csv_path,vis_pa
     #trips_tp_tn.to_pickle(pickle_path + 'trips_tp_tn' + str(cls))
     print('Exporting cluster ' + str(cls) + ' output to CSV...')
     sing_output = xlmhg\
-        .merge(t_test, on='gene_1')\
-        .merge(fc_test, on='gene_1')\
+        .merge(sing_stats, on='gene_1')\
         .merge(sing_tp_tn, on='gene_1')\
         .merge(q_val, on='gene_1')\
-        .set_index('gene_1')\
-        .sort_values(by='mHG_stat', ascending=True)
-
-    sing_output['hgrank'] = sing_output.reset_index().index + 1
-    sing_output.sort_values(by='Log2FoldChange', ascending=False, inplace=True)
-    sing_output['fcrank'] = sing_output.reset_index().index + 1
-    sing_output['finrank'] = sing_output[['hgrank', 'fcrank']].mean(axis=1)
-    sing_output.sort_values(by='finrank',ascending=True,inplace=True)
-    sing_output['rank'] = sing_output.reset_index().index + 1
-    sing_output.drop('finrank',axis=1, inplace=True)
-    count = 1
-    for index,row in sing_output.iterrows():
-        if count == 100:
-            break
-        sing_output.at[index,'Plot'] = 1
-        count = count + 1
+        .set_index('gene_1')
+
+    #hgrank is the position by mHG_stat ascending, fcrank by Log2FoldChange
+    #descending (NaN last), rank the position by their mean. Ties fall back
+    #to the previous rank, as sorting one order after the other would.
+    sing_count = len(sing_output)
+    positions = np.arange(1, sing_count + 1)
+    hgrank = np.empty(sing_count, dtype=int)
+    hgrank[np.argsort(sing_output['mHG_stat'].values, kind='stable')] = positions
+    fcrank = np.empty(sing_count, dtype=int)
+    fcrank[np.lexsort((hgrank, -sing_output['Log2FoldChange'].values))] = positions
+    sing_output['hgrank'] = hgrank
+    sing_output['fcrank'] = fcrank
+    sing_output = sing_output.iloc[
+        np.lexsort((fcrank, hgrank + fcrank))
+    ].assign(rank=positions)
+    #only plot the top 100 singletons
+    sing_output['Plot'] = 0
+    sing_output.iloc[:100, sing_output.columns.get_loc('Plot')] = 1
 
 
     
-    sing_output.to_csv(
-        csv_path + '/cluster_' + str(cls) + '_singleton.csv'
+    write_csv(
+        sing_output, csv_path + '/cluster_' + str(cls) + '_singleton.csv', fast_io
     )
     sing_stripped = sing_output[
         ['mHG_stat', 'TP', 'TN']
@@ -417,33 +503,37 @@ def process(cls,X,L,plot_pages,cls_ser,tsne,marker_exp,gene_file,csv_path,vis_pa
     
 
     ranked_print = ranked_pair.head(Trim)
-    ranked_print.to_csv(
-        csv_path + '/cluster_' + str(cls) + '_pair_final_ranking.csv'
+    write_csv(
+        ranked_print, csv_path + '/cluster_' + str(cls) + '_pair_final_ranking.csv', fast_io
     )
     #Add trips data pages
     #does not currently do new rank scheme
     if K == 3:
-        trips_output = trips\
-          .sort_values(by='HG_stat', ascending=True)
-          #print(trips_output)
-        trips_output['rank'] = trips_output.reset_index().index + 1
+        #vis.make_plots only draws the top plot_pages
+        trips_output = hgmd.top_k_sorted(
+            trips, 'HG_stat', max(Trim, plot_pages)
+        )
+        trips_output['rank'] = np.arange(1, len(trips_output) + 1)
         trips_print = trips_output.head(Trim)
-        trips_print.to_csv(
-            csv_path + '/cluster_' + str(cls) + '_trips.csv'
+        write_csv(
+            trips_print, csv_path + '/cluster_' + str(cls) + '_trips.csv', fast_io
             )
     else:
         trips_output = int(1)
     if K >= 4:
-        quads_final = quads_fin\
-          .sort_values(by='HG_stat', ascending=True)
-        quads_final['rank'] = quads_final.reset_index().index + 1
+        quads_final = hgmd.top_k_sorted(
+            quads_fin, 'HG_stat', max(Trim, plot_pages)
+        )
+        quads_final['rank'] = np.arange(1, len(quads_final) + 1)
         quads_print = quads_final.head(Trim)
-        quads_print.to_csv(
-            csv_path + '/cluster_' + str(cls) + '_quads.csv'
+        write_csv(
+            quads_print, csv_path + '/cluster_' + str(cls) + '_quads.csv', fast_io
             )
     else:
         quads_final = int(1)
     print('Drawing plots...')
+    #imported here so matplotlib is only loaded by workers that plot
+    from . import visualize as vis
     #plt.bar(list(histogram.keys()), histogram.values(), color='b')
     #plt.savefig(vis_path + '/cluster_' + str(cls) + '_pair_histogram')
 
@@ -472,6 +562,56 @@ def process(cls,X,L,plot_pages,cls_ser,tsne,marker_exp,gene_file,csv_path,vis_pa
     #time.sleep(10000)
 
 
+#per-worker inputs shared by every cluster, set up by init_worker
+_shared = {}
+
+
+def init_worker(shm_name, shape, dtype, index, columns, cls_ser, tsne, order_name, order_shape, order_dtype):
+    """
+    Pool initializer. Attaches to the shared memory blocks holding the
+    marker expression matrix and its per-gene descending sort order
+    (see hgmd.descending_order), and wraps them without copying.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _shared['shm'] = shm
+    _shared['marker_exp'] = pd.DataFrame(
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf),
+        index=index, columns=columns, copy=False
+    )
+    order_shm = shared_memory.SharedMemory(name=order_name)
+    _shared['order_shm'] = order_shm
+    _shared['order'] = np.ndarray(
+        order_shape, dtype=order_dtype, buffer=order_shm.buf
+    )
+    if cls_ser.index.equals(index):
+        cls_ser.index = _shared['marker_exp'].index
+    _shared['cls_ser'] = cls_ser
+    _shared['tsne'] = tsne
+
+
+def process_shared(cls,X,L,plot_pages,gene_file,csv_path,vis_path,pickle_path,cluster_number,K,abbrev,cluster_overall,Trim,fast_io,xlmhg=None):
+    """
+    Runs process() for one cluster on the inputs set up by init_worker.
+    """
+    process(
+        cls,X,L,plot_pages,_shared['cls_ser'],_shared['tsne'],
+        _shared['marker_exp'],gene_file,csv_path,vis_path,pickle_path,
+        cluster_number,K,abbrev,cluster_overall,Trim,fast_io,xlmhg,
+        _shared['order']
+    )
+
+
+def xlmhg_shared(cls, X, L, start, stop):
+    """
+    Runs the singleton XL-mHG test for one cluster on genes start:stop of the
+    marker expression matrix set up by init_worker.
+    """
+    return hgmd.batch_xlmhg(
+        _shared['marker_exp'].iloc[:, start:stop], _shared['cls_ser'], cls,
+        X=X, L=L, order=_shared['order'][:, start:stop], verbose=start == 0
+    )
+
+
 def main():
     """Hypergeometric marker detection. Finds markers identifying a cluster.
 
@@ -487,6 +627,8 @@ def main():
 
     start_dt = datetime.datetime.now()
     start_time = time.time()
+    #plots only go to PDF, no need for matplotlib to probe GUI backends
+    os.environ.setdefault('MPLBACKEND', 'Agg')
     print("Started on " + str(start_dt.isoformat()))
     args = init_parser(argparse.ArgumentParser(
         description=("Hypergeometric marker detection. Finds markers identifying a cluster. Documentation available at https://hgmd.readthedocs.io/en/latest/index.html")
@@ -503,6 +645,7 @@ def main():
     cluster_file = args.cluster
     gene_file = args.g
     Trim = args.Trim
+    FastIO = args.FastIO
     plot_pages = 30  # number of genes to plot (starting with highest ranked)
 
     # TODO: gene pairs with expression ratio within the cluster of interest
@@ -513,23 +656,14 @@ def main():
     csv_path = output_path + 'data/'
     vis_path = output_path + 'vis/'
     pickle_path = output_path + '_pickles/'
-    try:
-        os.makedirs(csv_path)
-    except:
-        os.system('rm -r ' + csv_path)
-        os.makedirs(csv_path)
+    shutil.rmtree(csv_path, ignore_errors=True)
+    os.makedirs(csv_path, exist_ok=True)
 
-    try:
-        os.makedirs(vis_path)
-    except:
-        os.system('rm -r ' + vis_path)
-        os.makedirs(vis_path)
+    shutil.rmtree(vis_path, ignore_errors=True)
+    os.makedirs(vis_path, exist_ok=True)
 
-    try:
-        os.makedirs(pickle_path)
-    except:
-        os.system('rm -r ' + pickle_path)
-        os.makedirs(pickle_path)
+    shutil.rmtree(pickle_path, ignore_errors=True)
+    os.makedirs(pickle_path, exist_ok=True)
 
     if Trim is not None:
         Trim = int(Trim)
@@ -569,16 +703,19 @@ def main():
             gene_path=gene_file,
             D=Down
         )
+    #throw out vals that show up in expression matrix but not in cluster assignments
+    #(before complements are generated, so none are made for dropped cells).
+    #Cluster and marker files usually list the same cells in the same order,
+    #in which case neither the aligning take nor the sort copies the matrix.
+    if not no_complement_marker_exp.index.equals(cls_ser.index):
+        no_complement_marker_exp = no_complement_marker_exp.loc[
+            no_complement_marker_exp.index.intersection(cls_ser.index)
+        ]
+    if not no_complement_marker_exp.index.is_monotonic_increasing:
+        no_complement_marker_exp = no_complement_marker_exp.sort_index()
     print("Generating complement data...")
     marker_exp = hgmd.add_complements(no_complement_marker_exp)
-    #throw out vals that show up in expression matrix but not in cluster assignments
-    for ind,row in marker_exp.iterrows():
-        if ind in cls_ser.index.values.tolist():
-            continue
-        else:
-            marker_exp.drop(ind, inplace=True)
-        #print(marker_exp.index.values.tolist().count(str(ind)))
-        #print(marker_exp[index])
+    del no_complement_marker_exp
 
     #throw out gene rows that are duplicates and print out a message to user
     
@@ -593,40 +730,103 @@ def main():
         else:
             cls_ser.drop(index,inplace=True)
     '''
-    marker_exp.sort_values(by='cell',inplace=True)
     cls_ser.sort_index(inplace=True)
+    #cluster labels become a categorical over the sorted cluster set, so the
+    #per-cluster masks compare small integer codes. Sharing marker_exp's
+    #index object lets pandas skip aligning those masks to the matrix.
+    #Rows stay in cell order; grouping them by cluster would bias how
+    #XL-mHG breaks expression ties.
+    cls_ser = cls_ser.astype(pd.CategoricalDtype(sorted(cls_ser.unique())))
+    if cls_ser.index.equals(marker_exp.index):
+        cls_ser.index = marker_exp.index
 
     
     # Process clusters sequentially
-    clusters = cls_ser.unique()
-    clusters.sort()
+    clusters = np.array(cls_ser.cat.categories)
     cluster_overall=clusters.copy()
 
-    #Below could probably be optimized a little (new_clust not necessary),
-    #cores is number of simultaneous threads you want to run, can be set at will
+    #cores is number of simultaneous workers you want to run, can be set at will
     cores = C
     cluster_number = len(clusters)
     # if core number is bigger than number of clusters, set it equal to number of clusters
     if cores > len(clusters):
         cores = len(clusters)
-    #below loops allow for splitting the job based on core choice
-    group_num  = math.ceil((len(clusters) / cores ))
-    for element in range(group_num):
-        new_clusters = clusters[:cores]
-        print(new_clusters)
-        jobs = []
-        #this loop spawns the workers and runs the code for each assigned.
-        #workers assigned based on the new_clusters list which is the old clusters
-        #split up based on core number e.g.
-        #clusters = [1 2 3 4 5 6] & cores = 4 --> new_clusters = [1 2 3 4], new_clusters = [5 6]
-        for cls in new_clusters:
-            p = multiprocessing.Process(target=process,
-                args=(cls,X,L,plot_pages,cls_ser,tsne,marker_exp,gene_file,csv_path,vis_path,pickle_path,cluster_number,K,Abbrev,cluster_overall,Trim))
-            jobs.append(p)
-            p.start()
-        p.join()
-        new_clusters = []
-        clusters = clusters[cores:len(clusters)]
+    #marker_exp goes into shared memory once; workers get a view of it
+    #instead of a pickled copy each. maxtasksperchild=1 keeps the old
+    #fresh-process-per-cluster behaviour.
+    values = marker_exp.values
+    shape, dtype = values.shape, values.dtype
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    #every cluster's XL-mHG tests rank cells by the same per-gene sort, so
+    #it is done once here (on all C cores) and shared the same way. XL-mHG
+    #only looks at the top L cells, so only the largest L any cluster uses
+    #is kept, as int32 cell positions.
+    if L is not None:
+        order_rows = L
+    else:
+        order_rows = min(shape[0], 2*int(cls_ser.value_counts().max()))
+    order_shape = (order_rows, shape[1])
+    order_dtype = np.dtype(np.int32)
+    order_shm = shared_memory.SharedMemory(
+        create=True, size=max(order_rows * shape[1] * order_dtype.itemsize, 1)
+    )
+    try:
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf)[:] = values
+        #the parent works on the shared copy from here on, so its private
+        #matrix can be freed instead of being held for the whole run
+        del values
+        marker_exp = pd.DataFrame(
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf),
+            index=marker_exp.index, columns=marker_exp.columns, copy=False
+        )
+        print('Sorting genes...')
+        hgmd.descending_order(
+            marker_exp,
+            out=np.ndarray(order_shape, dtype=order_dtype, buffer=order_shm.buf),
+            threads=C, complements=True
+        )
+        initargs = (
+            shm.name, shape, dtype,
+            marker_exp.index, marker_exp.columns, cls_ser, tsne,
+            order_shm.name, order_shape, order_dtype
+        )
+        #with more cores than clusters, the per-cluster pool would leave
+        #cores idle; instead split each cluster's singleton XL-mHG tests
+        #into blocks of genes and run those on all C cores first
+        xlmhg = {cls: None for cls in clusters}
+        gene_splits = C // cluster_number
+        if gene_splits > 1:
+            print('Running XL-mHG on singletons in ' + str(gene_splits) + ' gene blocks per cluster...')
+            step = math.ceil(marker_exp.shape[1] / gene_splits)
+            tasks = [
+                (cls, X, L, start, start + step)
+                for cls in clusters
+                for start in range(0, marker_exp.shape[1], step)
+            ]
+            with multiprocessing.Pool(
+                C, initializer=init_worker, initargs=initargs
+            ) as pool:
+                blocks = pool.starmap(xlmhg_shared, tasks, chunksize=1)
+            for cls in clusters:
+                xlmhg[cls] = pd.concat(
+                    [block for task, block in zip(tasks, blocks) if task[0] == cls],
+                    ignore_index=True
+                )
+        with multiprocessing.Pool(
+            cores, initializer=init_worker, maxtasksperchild=1,
+            initargs=initargs
+        ) as pool:
+            pool.starmap(process_shared, [
+                (cls,X,L,plot_pages,gene_file,csv_path,vis_path,pickle_path,cluster_number,K,Abbrev,cluster_overall,Trim,FastIO,xlmhg[cls])
+                for cls in clusters
+            ], chunksize=1)
+    finally:
+        #no view of the shared buffer may be left when it is closed
+        del marker_exp
+        shm.close()
+        shm.unlink()
+        order_shm.close()
+        order_shm.unlink()
 
     end_time = time.time()
 
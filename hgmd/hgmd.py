@@ -7,14 +7,12 @@ insignificant.  I.e. 15.001 and 15.000 are treated as equivalent expression
 values.
 """
 
-import re
-
 import pandas as pd
 import numpy as np
 import xlmhg as hg
+from multiprocessing.pool import ThreadPool
 import scipy.stats as ss
 import time
-import math
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import log_loss
 from . import qvalue
@@ -25,6 +23,13 @@ from . import qvalue
 # Used for comparision of marker expression values.
 FLOAT_PRECISION = 0.001
 
+# Genes sorted (or ranked) together per block in the singleton tests.
+XLMHG_BLOCK = 256
+
+# Genes expressed (nonzero) in fewer than this fraction of cells are sorted
+# by their nonzero values only, see sparse_descending_order.
+SPARSE_DENSITY = 0.5
+
 
 def add_complements(marker_exp):
     """Adds columns representing gene complement to a gene expression matrix.
@@ -44,13 +49,18 @@ def add_complements(marker_exp):
 
     :returns: A DataFrame of same format as marker_exp, but with a new column
               added for each existing column label, representing the column
-              label gene's complement.
+              label gene's complement. The values are held in a single
+              contiguous block, genes first and complements after.
 
     :rtype: pandas.DataFrame
     """
-    for gene in marker_exp.columns:
-        #marker_exp[gene + '_negation'] = 1/(1+marker_exp[gene])
-        marker_exp[gene + '_negation'] = -marker_exp[gene]
+    values = marker_exp.values
+    #marker_exp[gene + '_negation'] = 1/(1+marker_exp[gene])
+    marker_exp = pd.DataFrame(
+        np.hstack([values, -values]),
+        index=marker_exp.index,
+        columns=marker_exp.columns.append(marker_exp.columns + '_negation')
+    )
     '''
     for gene in marker_exp.columns:
         marker_exp[gene + '_c'] = max(marker_exp[gene]) - marker_exp[gene]
@@ -58,7 +68,174 @@ def add_complements(marker_exp):
     return marker_exp
 
 
-def batch_xlmhg(marker_exp, c_list, coi, X=None, L=None):
+def cluster_mask(marker_exp, c_list, coi):
+    """Finds which cells of a gene expression matrix are in the cluster of interest.
+
+    Computed once per test function and reused for every gene, in place of
+    comparing c_list to coi inside the per-gene work.
+
+    :param marker_exp: A DataFrame whose rows are cell identifiers, columns are
+        gene identifiers, and values are float values representing gene
+        expression.
+    :param c_list: A Series whose indices are cell identifiers, and whose
+        values are the cluster which that cell is part of.
+    :param coi: The cluster of interest.
+
+    :returns: A boolean array, aligned to the rows of marker_exp, that is True
+              for cells in coi.
+
+    :rtype: numpy.ndarray
+    """
+    return (c_list.reindex(marker_exp.index) == coi).values
+
+
+def sparse_descending_order(values):
+    """Stable descending argsort of a mostly zero expression vector.
+
+    Single cell expression is mostly zeros, which a full sort spends most of
+    its time on. Here only the nonzero values are sorted; the zeros, all
+    tied, go between the positive and negative ones in index order. The
+    result is identical to np.argsort(-values, kind='stable').
+
+    :param values: A 1-dimensional array of gene expression values.
+
+    :returns: Positions of values, by descending value.
+
+    :rtype: numpy.ndarray
+    """
+    is_zero = values == 0
+    zero = np.flatnonzero(is_zero)
+    nonzero = np.flatnonzero(~is_zero)
+    nonzero = nonzero[np.argsort(-values[nonzero], kind='stable')]
+    #positives come before the zeros; negatives (then any NaN) after
+    n_pos = np.count_nonzero(values[nonzero] > 0)
+    return np.concatenate([nonzero[:n_pos], zero, nonzero[n_pos:]])
+
+
+def ascending_order(values, order):
+    """Stable ascending argsort of values, from their stable descending argsort.
+
+    Reversing the descending order sorts values ascending, but leaves each run
+    of tied values in reverse index order; reversing every run back gives
+    exactly np.argsort(values, axis=0, kind='stable') without sorting again.
+
+    :param values: A 2-dimensional array of gene expression values, one gene
+        per column.
+    :param order: The stable descending argsort of values along axis 0.
+
+    :returns: Positions of values, by ascending value, one gene per column.
+
+    :rtype: numpy.ndarray
+    """
+    if np.isnan(values).any():
+        #NaN sorts last both ways, so it is not where reversing puts it
+        return np.argsort(values, axis=0, kind='stable')
+    n = len(order)
+    rev = order[::-1]
+    sorted_values = np.take_along_axis(values, rev, axis=0)
+    pos = np.broadcast_to(np.arange(n)[:, np.newaxis], rev.shape)
+    new_run = np.ones(rev.shape, dtype=bool)
+    new_run[1:] = sorted_values[1:] != sorted_values[:-1]
+    run_end = np.ones(rev.shape, dtype=bool)
+    run_end[:-1] = new_run[1:]
+    start = np.maximum.accumulate(np.where(new_run, pos, 0), axis=0)
+    end = np.minimum.accumulate(
+        np.where(run_end, pos, n - 1)[::-1], axis=0
+    )[::-1]
+    return np.take_along_axis(rev, start + end - pos, axis=0)
+
+
+def descending_order(marker_exp, out=None, threads=1, complements=False):
+    """Argsorts every gene of a gene expression matrix by descending expression.
+
+    The ranked lists XL-mHG tests are these orders; only the membership
+    gathered through them depends on the cluster of interest. Computing them
+    once lets batch_xlmhg skip sorting for every cluster. Ties keep cell (row)
+    order.
+
+    :param marker_exp: A DataFrame whose rows are cell identifiers, columns are
+        gene identifiers, and values are float values representing gene
+        expression.
+    :param out: Optional integer array to write into, with marker_exp's
+        number of columns. If it has fewer rows than marker_exp, only that
+        many top positions of each gene are kept.
+    :param threads: Number of threads sorting blocks of genes. NumPy sorts
+        without holding the GIL, so threads run in parallel.
+    :param complements: True if marker_exp is laid out as add_complements
+        builds it, genes first and their negations after. Only the genes are
+        sorted; a negation's order is its gene's order reversed (see
+        ascending_order).
+
+    :returns: An array whose column j holds the row positions of marker_exp
+              sorted by descending expression of gene j (int32 unless out is
+              given).
+
+    :rtype: numpy.ndarray
+    """
+    E = marker_exp.to_numpy(copy=False)
+    if out is None:
+        #cell positions fit int32, half the bytes of numpy's intp
+        out = np.empty(E.shape, dtype=np.int32)
+
+    rows = out.shape[0]
+    genes = E.shape[1] // 2 if complements else E.shape[1]
+
+    def store(cols, block, order):
+        out[:, cols] = order[:rows]
+        if complements:
+            out[:, cols + genes] = ascending_order(block, order)[:rows]
+
+    def sort_block(start):
+        block = E[:, start:min(start + XLMHG_BLOCK, genes)]
+        sparse = np.count_nonzero(block, axis=0) < SPARSE_DENSITY * len(block)
+        dense = np.flatnonzero(~sparse)
+        if len(dense):
+            store(
+                start + dense, block[:, dense],
+                np.argsort(-block[:, dense], axis=0, kind='stable')
+            )
+        for j in np.flatnonzero(sparse):
+            store(
+                np.array([start + j]), block[:, [j]],
+                sparse_descending_order(block[:, j])[:, np.newaxis]
+            )
+
+    starts = range(0, genes, XLMHG_BLOCK)
+    if threads > 1:
+        with ThreadPool(threads) as pool:
+            pool.map(sort_block, starts)
+    else:
+        for start in starts:
+            sort_block(start)
+    return out
+
+
+def top_order(values, L):
+    """Finds the first L entries of the stable descending argsort of values.
+
+    Selects them with a linear time partition and sorts only those, instead of
+    sorting all of values. Ties at the L-th value are taken in index order,
+    as the full stable sort would.
+
+    :param values: A 1-dimensional array of gene expression values.
+    :param L: Number of top positions wanted.
+
+    :returns: Positions of the L largest values, by descending value.
+
+    :rtype: numpy.ndarray
+    """
+    if L >= len(values):
+        return np.argsort(-values, kind='stable')
+    if L <= 0:
+        return np.empty(0, dtype=np.intp)
+    kth = -np.partition(-values, L - 1)[L - 1]
+    above = np.flatnonzero(values > kth)
+    tied = np.flatnonzero(values == kth)[:L - len(above)]
+    top = np.sort(np.concatenate([above, tied]))
+    return top[np.argsort(-values[top], kind='stable')]
+
+
+def batch_xlmhg(marker_exp, c_list, coi, X=None, L=None, order=None, verbose=True):
     """Applies XL-mHG test to a gene expression matrix, gene by gene.
 
     Outputs a 3-column DataFrame representing statistical results of XL-mHG.
@@ -71,6 +248,10 @@ def batch_xlmhg(marker_exp, c_list, coi, X=None, L=None):
     :param coi: The cluster of interest.
     :param X: An integer to be used as argument to the XL-mHG test.
     :param L: An integer to be used as argument to the XL-mHG test.
+    :param order: Optional output of descending_order(marker_exp), with at
+        least L rows. Sorted here, a block of genes at a time, if not given.
+    :param verbose: Print the X and L used and the cluster size. Calls on
+        several blocks of genes of one cluster only need to print once.
 
     :returns: A matrix with arbitrary row indices, whose columns are the gene
               name, stat, cutoff, and pval outputs of the XL-mHG test; of
@@ -79,62 +260,65 @@ def batch_xlmhg(marker_exp, c_list, coi, X=None, L=None):
 
     :rtype: pandas.DataFrame
     """
-    # * 1 converts to integer
-    mem_list = (c_list == coi) * 1
-    #count_n = 0
-    #count_2n = 0
+    #membership of each marker_exp row in coi, as one int8 vector
+    mem = cluster_mask(marker_exp, c_list, coi).astype(np.int8)
     #Count the number of cells in the cluster, store into count_n
-    count_n = np.sum(mem_list)
-    '''
-    for cell in mem_list:
-        if cell == 1:
-            count_n = count_n + 1
-        else:
-            continue
-    '''
-    #Twice the number of cells in the cluster
-    #count_2n = count_n * 2
+    count_n = int(mem.sum())
     #Set X and L params
     if X is None:
-        X = np.int(.15*count_n)
+        X = int(.15*count_n)
     if L is None:
         if 2*count_n >= marker_exp.shape[0]:
-            L = np.int(marker_exp.shape[0])
+            L = int(marker_exp.shape[0])
         else:
-            L = np.int(2*count_n)
+            L = int(2*count_n)
        #L = marker_exp.shape[0]
-    print('X = ' + str(X))
-    print('L = ' + str(L))
-    print('Cluster size ' + str(count_n))
-    xlmhg = marker_exp.apply(
-        lambda col:
-        hg.xlmhg_test(
-            mem_list.reindex(
-                col.sort_values(ascending=False).index
-            ).values,
-            X=X,
-            L=L
-        )
-    )
-    xlmhg_1 = marker_exp.apply(
-        lambda col:
-        hg.get_xlmhg_test_result(N=len(mem_list),
-                                     indices=np.array(np.where(np.array(mem_list.reindex(col.sort_values(ascending=False).index).values==1))[0],dtype='int64').astype('uint16')
-                                     ,X=X,L=L,pval_thresh=1e-12,escore_pval_thresh=1e-1,tol=1e-12).escore
-        )
-    output = pd.DataFrame()
-    output['gene_1'] = xlmhg.index
-    output[['mHG_stat', 'mHG_cutoff', 'mHG_pval']] = pd.DataFrame(
-        xlmhg.values.tolist(),
-        columns=['mHG_stat', 'mHG_cutoff', 'mHG_pval']
-    )
-    '''
-    print(xlmhg_1)
-    output['escore'] = np.array(xlmhg_1,dtype=float)
-    output.fillna(0,inplace=True)
-    print(output.sort_values(by='escore', ascending=False))
-    time.sleep(1000)
-    '''
+    if verbose:
+        print('X = ' + str(X))
+        print('L = ' + str(L))
+        print('Cluster size ' + str(count_n))
+    E = marker_exp.to_numpy(dtype=np.float32, copy=False)
+    n_genes = E.shape[1]
+    mhg_stat = np.empty(n_genes)
+    mhg_cutoff = np.empty(n_genes, dtype=np.int64)
+    mhg_pval = np.empty(n_genes)
+    n_cells = E.shape[0]
+    #dynamic programming table for the p-values, allocated once instead of
+    #inside every test (its size only depends on N and K)
+    table = np.empty((count_n + 1, n_cells - count_n + 1), dtype=np.longdouble)
+    #gather membership in sorted order a block of genes at a time; bounds
+    #the index matrix for wide inputs when sorting here
+    for start in range(0, n_genes, XLMHG_BLOCK):
+        stop = min(start + XLMHG_BLOCK, n_genes)
+        if order is None:
+            #XL-mHG only places cutoffs within the top L, so only those
+            #need to be in sorted order
+            top = np.column_stack([
+                top_order(E[:, j], L) for j in range(start, stop)
+            ])
+        else:
+            top = order[:L, start:stop]
+        #one row of top L membership per gene
+        V = mem[top.T]
+        #below the top L only the number of cluster cells matters (it
+        #sets K), not where they fall, so they are packed right after it
+        rest = count_n - V.sum(axis=1, dtype=np.int64)
+        for j in range(V.shape[0]):
+            indices = np.concatenate([
+                np.flatnonzero(V[j]), np.arange(L, L + rest[j])
+            ]).astype(np.uint16)
+            result = hg.get_xlmhg_test_result(
+                n_cells, indices, X=X, L=L, table=table
+            )
+            mhg_stat[start + j] = result.stat
+            mhg_cutoff[start + j] = result.cutoff
+            mhg_pval[start + j] = result.pval
+    output = pd.DataFrame({
+        'gene_1': marker_exp.columns,
+        'mHG_stat': mhg_stat,
+        'mHG_cutoff': mhg_cutoff,
+        'mHG_pval': mhg_pval,
+    })
     return output
 
 
@@ -180,7 +364,7 @@ def batch_stats_extended(marker_exp, c_list, coi):
     """
     def LRT_LogReg(df):
         # Define model matrix and response
-        X = np.matrix(df.drop('cluster', axis=1))
+        X = np.asarray(df.drop('cluster', axis=1))
         y = df['cluster']
         # Train logistic regression with full model
         logreg1 = LogisticRegression().fit(X,y)
@@ -246,9 +430,77 @@ def batch_stats_extended(marker_exp, c_list, coi):
     return output
 
 
+def singleton_stats(marker_exp, c_list, coi):
+    """Applies t test, wilcoxon rank sum test and log2 fold change to a gene
+    expression matrix, in one pass.
+
+    Genes are taken a block at a time; each block is split into the cluster's
+    cells and the rest once, and all three statistics are computed from that
+    split while it is in cache:
+
+    - Welch's t test, as scipy.stats.ttest_ind(..., equal_var=False), from
+      per-gene means and variances accumulated in float64.
+    - The rank sum test, as scipy.stats.ranksums, from one rankdata call over
+      the block (ties get average ranks, as there).
+    - log2 of the ratio of cluster to population mean (its absolute value;
+      nan if either mean is zero).
+
+    :param marker_exp: A DataFrame whose rows are cell identifiers, columns are
+        gene identifiers, and values are float values representing gene
+        expression.
+    :param c_list: A Series whose indices are cell identifiers, and whose
+        values are the cluster which that cell is part of.
+    :param coi: The cluster of interest.
+
+    :returns: A matrix with arbitary row indices whose columns are the gene
+              and the statistics, all but the first of float type.  Their
+              names are 'gene_1', 't_stat', 't_pval', 'w_stat', 'w_pval',
+              'Log2FoldChange', 'Log2FoldChangeAbs'.
+
+    :rtype: pandas.DataFrame
+    """
+    mask = cluster_mask(marker_exp, c_list, coi)
+    E = marker_exp.to_numpy(copy=False)
+    n_genes = E.shape[1]
+    n1 = int(mask.sum())
+    n0 = len(mask) - n1
+    t_stat, t_pval, rank_sum, fc = (np.empty(n_genes) for _ in range(4))
+    for start in range(0, n_genes, XLMHG_BLOCK):
+        stop = min(start + XLMHG_BLOCK, n_genes)
+        block = E[:, start:stop]
+        sample, population = block[mask], block[~mask]
+        mean1 = sample.mean(axis=0, dtype=np.float64)
+        mean0 = population.mean(axis=0, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_stat[start:stop], t_pval[start:stop] = ss.ttest_ind_from_stats(
+                mean1, np.sqrt(sample.var(axis=0, ddof=1, dtype=np.float64)), n1,
+                mean0, np.sqrt(population.var(axis=0, ddof=1, dtype=np.float64)), n0,
+                equal_var=False
+            )
+            fc[start:stop] = np.log2(np.abs(np.where(
+                (mean1 == 0) | (mean0 == 0), np.nan, mean1 / mean0
+            )))
+        rank_sum[start:stop] = ss.rankdata(block, axis=0)[mask].sum(axis=0)
+    expected = n1 * (n1 + n0 + 1) / 2.0
+    w_stat = (rank_sum - expected) / np.sqrt(n1 * n0 * (n1 + n0 + 1) / 12.0)
+    output = pd.DataFrame()
+    output['gene_1'] = marker_exp.columns
+    output['t_stat'] = t_stat
+    output['t_pval'] = t_pval
+    output['w_stat'] = w_stat
+    output['w_pval'] = 2 * ss.norm.sf(np.abs(w_stat))
+    output['Log2FoldChange'] = fc
+    output['Log2FoldChangeAbs'] = np.abs(fc)
+    return output
+
+
 def batch_stats(marker_exp, c_list, coi):
     """Applies t test & wilcoxon rank sum test to a gene expression matrix, gene by gene.
 
+    Kept for compatibility: it runs the whole of singleton_stats and keeps
+    only the test columns, so callers wanting fold change too should call
+    singleton_stats once instead.
+
     :param marker_exp: A DataFrame whose rows are cell identifiers, columns are
         gene identifiers, and values are float values representing gene
         expression.
@@ -262,40 +514,18 @@ def batch_stats(marker_exp, c_list, coi):
 
     :rtype: pandas.DataFrame
     """
-        
-    t = marker_exp.apply(
-        lambda col:
-        ss.ttest_ind(
-            col[c_list == coi],
-            col[c_list != coi],
-            equal_var=False
-        )
-    )
-    ws = marker_exp.apply(
-        lambda col:
-        ss.ranksums(
-            col[c_list == coi],
-            col[c_list != coi]
-        )
-    )
-    output = pd.DataFrame()
-    output['gene_1'] = t.index
-    #output['gene_1'] = ws.index
-    output[['t_stat', 't_pval']] = pd.DataFrame(
-        t.values.tolist(),
-        columns=['t_stat', 't_pval']
-    )
-    output[['w_stat', 'w_pval']] = pd.DataFrame(
-        ws.values.tolist(),
-        columns=['w_stat', 'w_pval']
-    )
-
-    return output
+    return singleton_stats(marker_exp, c_list, coi)[
+        ['gene_1', 't_stat', 't_pval', 'w_stat', 'w_pval']
+    ]
 
 
 def batch_fold_change(marker_exp, c_list, coi):
     """Applies log2 fold change to a gene expression matrix, gene by gene.
 
+    Kept for compatibility: it runs the whole of singleton_stats and keeps
+    only the fold change columns, so callers wanting the t and rank sum
+    tests too should call singleton_stats once instead.
+
     :param marker_exp: A DataFrame whose rows are cell identifiers, columns are
         gene identifiers, and values are float values representing gene
         expression.
@@ -304,42 +534,9 @@ def batch_fold_change(marker_exp, c_list, coi):
     :param coi: The cluster of interest.
     :rtype: pandas.DataFrame
     """
-    
-    def fold_change(col,c_list,coi):
-        mean0 = col[c_list == coi].mean()
-        mean1 = col[c_list != coi].mean()
-        if mean0 == 0:
-            val = math.nan
-            return val
-        if mean1 == 0:
-            val = math.nan
-            return val
-        val = mean0/mean1
-        if val < 0:
-            return abs(val)
-        return val
-
-    
-    fc = marker_exp.apply(
-        lambda col:
-        (math.log(fold_change(col,c_list,coi),2))
-        )
-    fca = marker_exp.apply(
-        lambda col:
-        abs(math.log(fold_change(col,c_list,coi),2))
-        )
-    output = pd.DataFrame()
-    output['gene_1'] = fc.index
-    output[['Log2FoldChange']] = pd.DataFrame(
-        fc.values.tolist(),
-        columns=['Log2FoldChange']
-    )
-    output['gene_1'] = fca.index
-    output[['Log2FoldChangeAbs']] = pd.DataFrame(
-        fca.values.tolist(),
-        columns=['Log2FoldChangeAbs']
-    )
-    return output
+    return singleton_stats(marker_exp, c_list, coi)[
+        ['gene_1', 'Log2FoldChange', 'Log2FoldChangeAbs']
+    ]
 
 
 def mhg_cutoff_value(marker_exp, cutoff_ind):
@@ -369,20 +566,19 @@ def mhg_cutoff_value(marker_exp, cutoff_ind):
     :rtype: pandas.DataFrame
     """
 
-    def find_val(row):
-        gene = row['gene_1']
-        val = marker_exp[gene].sort_values(
-            ascending=False).iloc[row['mHG_cutoff']]
-        if re.compile(".*_negation$").match(gene):
-            return val + FLOAT_PRECISION
-        else:
-            return val + FLOAT_PRECISION
-
-    cutoff_ind.index = cutoff_ind['gene_1']
-    cutoff_val = cutoff_ind.apply(
-        find_val, axis='columns'
-    ).rename('cutoff_val')
-    output = cutoff_val.to_frame().reset_index()
+    E = marker_exp.to_numpy(copy=False)
+    cols = marker_exp.columns.get_indexer(cutoff_ind['gene_1'])
+    #cutoffs keep the matrix dtype (float32), so comparing expression to
+    #them later happens in that precision whatever numpy's promotion rules
+    cutoff_val = np.empty(len(cols), dtype=E.dtype)
+    #the value at sorted index k is the (k+1)th largest, which a partition
+    #finds in linear time without sorting the column
+    for i, (col, k) in enumerate(zip(cols, cutoff_ind['mHG_cutoff'].values)):
+        cutoff_val[i] = -np.partition(-E[:, col], k)[k]
+    output = pd.DataFrame({
+        'gene_1': cutoff_ind['gene_1'].values,
+        'cutoff_val': cutoff_val + E.dtype.type(FLOAT_PRECISION),
+    })
     return output
 
 
@@ -413,25 +609,15 @@ def mhg_slide(marker_exp, cutoff_val):
 
     :rtype: pandas.DataFrame
     """
-    def searcher(row):
-        if re.compile(".*_negation$").match(row['gene_1']):
-            val_ =  np.searchsorted(
-                -marker_exp[row['gene_1']].sort_values(ascending=False).values,
-                -row['cutoff_val'], side='left')
-        else:
-            val_ = np.searchsorted(
-                -marker_exp[row['gene_1']].sort_values(ascending=False).values,
-                -row['cutoff_val'], side='left')
-        
-        return val_
-        
-    cutoff_val.index = cutoff_val['gene_1']
-    cutoff_ind = cutoff_val.apply(lambda row: searcher(row),axis='columns')
-    output = cutoff_val
-    output['mHG_cutoff'] = cutoff_ind
-    # Reorder and remove redundant row index
-    output = output.reset_index(
-        drop=True)[['gene_1', 'mHG_cutoff', 'cutoff_val']]
+    #the slid index is where the cutoff value would be inserted into the
+    #descending sorted column, i.e. the number of cells expressing above it
+    E = marker_exp.to_numpy(copy=False)
+    cols = marker_exp.columns.get_indexer(cutoff_val['gene_1'])
+    output = pd.DataFrame({
+        'gene_1': cutoff_val['gene_1'].values,
+        'mHG_cutoff': (E[:, cols] > cutoff_val['cutoff_val'].values).sum(axis=0),
+        'cutoff_val': cutoff_val['cutoff_val'].values,
+    })
     return output
 
 
@@ -453,28 +639,57 @@ def discrete_exp(marker_exp, cutoff_val,trips_list):
 
     :rtype: pandas.DataFrame
     """
-    output = pd.DataFrame()
-    for gene in marker_exp.columns:
-        #if re.compile(".*_negation$").match(gene):
-        #    output[gene] = (abs(marker_exp[gene]) < abs(cutoff_val[gene])) * 1
-        #else:
-        output[gene] = (marker_exp[gene] > cutoff_val[gene]) * 1
+    #one comparison of the whole matrix against the row of cutoffs, rather
+    #than a Series comparison and column insert per gene
+    cutoffs = cutoff_val[marker_exp.columns].values
+    output = pd.DataFrame(
+        (marker_exp.to_numpy(copy=False) > cutoffs[np.newaxis, :]) * 1,
+        index=marker_exp.index,
+        columns=marker_exp.columns
+    )
 
     if trips_list is not None:
         #Ensures the matrix is in the proper order to get the top however many genes for the heuristic approach
         #create 'new_order', a list with the new ordering. trips_list goes first, rest after in any order
-        rest = []
-        for gene in output.columns:
-            if gene in trips_list:
-                continue
-            else:
-                rest.append(gene)       
+        keep = set(trips_list)
+        rest = [gene for gene in output.columns if gene not in keep]
         new_order = trips_list + rest
         output = output[new_order]
         
     return output
 
 
+def cluster_counts(discrete_exp, c_list, clusters):
+    """Counts expressing cells per cluster, for every gene, in one pass.
+
+    :param discrete_exp: A DataFrame whose rows are cell identifiers, columns
+        are gene identifiers, and values are boolean values representing gene
+        expression.
+    :param c_list: A Series whose indices are cell identifiers, and whose
+        values are the cluster which that cell is part of.  Must be in the
+        same row order as discrete_exp.
+    :param clusters: The clusters to count, in output row order.
+
+    :returns: (per-cluster expression counts, a clusters by genes array;
+              cells in each cluster; expressing cells in the population,
+              per gene)
+
+    :rtype: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+    """
+    # float32 counts are exact up to 2**24 cells
+    dtype = np.float32 if discrete_exp.shape[0] < 2**24 else np.float64
+    values = discrete_exp.values.astype(dtype)
+    # cells x clusters one-hot; one BLAS product gives every cluster's counts
+    membership = (
+        np.asarray(c_list)[:, np.newaxis] == np.asarray(clusters)[np.newaxis, :]
+    ).astype(dtype)
+    counts = np.matmul(np.transpose(membership), values)
+    sizes = np.sum(membership, 0)
+    total = np.sum(values, 0)
+    #exact integer counts; ratios downstream are taken in float64
+    return counts.astype(float), sizes.astype(float), total.astype(float)
+
+
 def tp_tn(discrete_exp, c_list, coi, cluster_overall):
     """Finds simple true positive/true negative values for the cluster of
     interest.
@@ -493,44 +708,29 @@ def tp_tn(discrete_exp, c_list, coi, cluster_overall):
     :rtype: pandas.DataFrame
     """
 
-    #does rest of clusters
     discrete_exp.fillna(0, inplace=True)
+    pop_count = discrete_exp.shape[0]
+    counts, sizes, total = cluster_counts(discrete_exp, c_list, cluster_overall)
+
+    def cluster_tp_tn(ind):
+        return pd.DataFrame({
+            'gene_1': discrete_exp.columns,
+            'TP': counts[ind] / sizes[ind],
+            'TN': (
+                ((pop_count - sizes[ind]) - (total - counts[ind]))
+                / (pop_count - sizes[ind])
+            )
+        }, columns=['gene_1', 'TP', 'TN'])
+
+    #does rest of clusters
     sing_cluster_exp_matrices = {}
-    for clstrs in cluster_overall:
+    for ind, clstrs in enumerate(cluster_overall):
         if clstrs == coi:
+            #does our cluster of interest
+            output = cluster_tp_tn(ind)
             continue
-        mem_list = (c_list == (clstrs)) * 1
-        tp_tn =discrete_exp.apply(
-            lambda col: (
-                np.dot(mem_list, col.values) / np.sum(mem_list),
-                np.dot(1 - mem_list, 1 - col.values) / np.sum(1 - mem_list),
-            )
-        )
-        sing_cluster_exp_matrices[clstrs] = pd.DataFrame()
-        sing_cluster_exp_matrices[clstrs]['gene_1'] = tp_tn.index
-        sing_cluster_exp_matrices[clstrs][['TP', 'TN']] = pd.DataFrame(
-            tp_tn.values.tolist(),
-            columns=['TP', 'TN']
-        )
-        sing_cluster_exp_matrices[clstrs].set_index('gene_1',inplace=True)
-        
+        sing_cluster_exp_matrices[clstrs] = cluster_tp_tn(ind).set_index('gene_1')
 
-    #does our cluster of interest
-    # * 1 converts to integer
-    mem_list = (c_list == coi) * 1
-    
-    tp_tn = discrete_exp.apply(
-        lambda col: (
-            np.dot(mem_list, col.values) / np.sum(mem_list),
-            np.dot(1 - mem_list, 1 - col.values) / np.sum(1 - mem_list)
-        )
-    )
-    output = pd.DataFrame()
-    output['gene_1'] = tp_tn.index
-    output[['TP', 'TN']] = pd.DataFrame(
-        tp_tn.values.tolist(),
-        columns=['TP', 'TN']
-    )
     #outputs a DF for COI and a dict of DF's for rest
     return output, sing_cluster_exp_matrices
 
@@ -584,12 +784,11 @@ def pair_product(discrete_exp, c_list, coi, cluster_number, trips_list,cluster_o
     if trips_list == None:
         pass
     else:
-        for column in discrete_exp:
-            #print(column)
-            if str(column) in trips_list:
-                continue
-            else:
-                discrete_exp.drop(column, axis=1,inplace=True)
+        keep = set(trips_list)
+        discrete_exp.drop(
+            [column for column in discrete_exp if str(column) not in keep],
+            axis=1, inplace=True
+        )
     ################
     '''
     
@@ -734,12 +933,11 @@ def combination_product(discrete_exp,c_list,coi,trips_list):
     if trips_list == None:
         pass
     else:
-        for column in discrete_exp:
-            #print(column)
-            if str(column) in trips_list:
-                continue
-            else:
-                discrete_exp.drop(column, axis=1,inplace=True)
+        keep = set(trips_list)
+        discrete_exp.drop(
+            [column for column in discrete_exp if str(column) not in keep],
+            axis=1, inplace=True
+        )
     ################
     
     
@@ -860,7 +1058,7 @@ def pair_hg(gene_map, in_cls_count, pop_count, in_cls_product, total_product,
 
     """
     
-    vhg = np.vectorize(ss.hypergeom.sf, excluded=[1, 2, 4], otypes=[np.float])
+    vhg = np.vectorize(ss.hypergeom.sf, excluded=[1, 2, 4], otypes=[float])
     ab = '2'
     if ab in abbrev:
         count = 0
@@ -905,12 +1103,15 @@ def pair_hg(gene_map, in_cls_count, pop_count, in_cls_product, total_product,
 
 
 
-def ranker(pair,xlmhg,sing_tp_tn,other_sing_tp_tn,other_pair_tp_tn,cls_counts,in_cls_count,pop_count):
+def ranker(pair,xlmhg,sing_tp_tn,other_sing_tp_tn,gene_map,cluster_exp_matrices,total_product,cls_counts,in_cls_count,pop_count):
     """
     :param pair: table w/ gene_1, gene_2, HG_stat as columns (DataFrame (DF) )
     :param xlmhg: DF of mHG stats for each gene(for testing lead vs follow gene in pair)
     :param other_sing_tp_tn: TP/TN values for singletons in all other clusters (dict of DFs)
-    :param other_pair_tp_tn: TP/TN values for pairs in all other clusters (dict of DFs)
+    :param gene_map: An Index mapping pair count matrix indices to gene names.
+    :param cluster_exp_matrices: paired expression count matrices for all
+        other clusters (dict of numpy arrays), from pair_product
+    :param total_product: The population paired expression count matrix.
     :param cls_counts: # of cells in a given cluster (dict of DFs)
     **
     All dicts have style: 
@@ -929,19 +1130,30 @@ def ranker(pair,xlmhg,sing_tp_tn,other_sing_tp_tn,other_pair_tp_tn,cls_counts,in
     -We are only taking the first 100 appearances for each gene in all the pairs
     -'Lead' gene is one with smallest p val
 
+    TN_after is the pair TN of pair_tp_tn, taken directly from the count
+    matrices since only the pairs visited below are ever needed.
+
     returns: New pair table w/ new columns and ranks.
     ranked-pair is a DEEP copy of pair, meaning value changes in it
     are not reflected in pair 
     """
 
-    def ranked_stat(gene_1,gene_2,lead_gene,cls_counts,other_pair_tp_tn,other_sing_tp_tn,in_cls_count):
+    gene_index = {gene: ind for ind, gene in enumerate(gene_map)}
+
+    def ranked_stat(gene_1,gene_2,lead_gene,cls_counts,other_sing_tp_tn,in_cls_count):
         stats=[]
         MGDstats=[]
         stats_debug = {}
+        ind_1 = gene_index[gene_1]
+        ind_2 = gene_index[gene_2]
+        taken_in_pop = total_product[ind_1, ind_2]
         for clstrs in cls_counts:
             TN_before = other_sing_tp_tn[clstrs].at[lead_gene,'TN']
-            TN_after = other_pair_tp_tn[clstrs].at[(gene_1,gene_2),'TN']
             N = cls_counts[clstrs]
+            TN_after = (
+                ((pop_count - N) - (taken_in_pop - cluster_exp_matrices[clstrs][ind_1, ind_2]))
+                / (pop_count - N)
+            )
             #value =  ( TN_after - TN_before ) / N
             value =  ( TN_after - TN_before )
             stats.append(value)
@@ -956,13 +1168,14 @@ def ranker(pair,xlmhg,sing_tp_tn,other_sing_tp_tn,other_pair_tp_tn,cls_counts,in
     
     xlmhg_cop = xlmhg.copy()
     xlmhg_cop = xlmhg_cop.set_index('gene_1')
-    ranked_pair = pair.copy()
+    ranked_pair = pair.iloc[
+        np.argsort(pair['HG_pval'].values, kind='stable')
+    ].copy()
     num_tests = len(ranked_pair)
-    ranked_pair.sort_values(by='HG_pval',ascending=True,inplace=True)
-    ranked_pair['HG_rank'] = ranked_pair.reset_index().index + 1
+    ranked_pair['HG_rank'] = np.arange(1, num_tests + 1)
     
     #below not used because this does ALL pairs (too many)
-    #ranked_pair['CCS'] = ranked_pair.apply(ranked_stat,axis=1,args=(cls_counts,other_pair_tp_tn,other_sing_tp_tn))
+    #ranked_pair['CCS'] = ranked_pair.apply(ranked_stat,axis=1,args=(cls_counts,other_sing_tp_tn))
     omit_pairs = {}
     count = 1
     if len(ranked_pair.index) < 5000:
@@ -972,17 +1185,17 @@ def ranker(pair,xlmhg,sing_tp_tn,other_sing_tp_tn,other_pair_tp_tn,cls_counts,in
     loopstart = time.time()
     
     for index,row in ranked_pair.iterrows():
-        if row[0] in omit_pairs:
-            if omit_pairs[row[0]] > 200:
+        if row.iloc[0] in omit_pairs:
+            if omit_pairs[row.iloc[0]] > 200:
                 ranked_pair.drop(index, inplace=True)
                 continue
-        if row[1] in omit_pairs:
-            if omit_pairs[row[1]] > 200:
+        if row.iloc[1] in omit_pairs:
+            if omit_pairs[row.iloc[1]] > 200:
                 ranked_pair.drop(index, inplace=True)
                 continue
         
-        gene_1 = row[0]
-        gene_2 = row[1]
+        gene_1 = row.iloc[0]
+        gene_2 = row.iloc[1]
         #determine which of the two genes is 'lead'
         stat_1 = xlmhg_cop.at[gene_1,'mHG_pval']
         stat_2 = xlmhg_cop.at[gene_2,'mHG_pval']
@@ -994,29 +1207,34 @@ def ranker(pair,xlmhg,sing_tp_tn,other_sing_tp_tn,other_pair_tp_tn,cls_counts,in
             follow_gene = gene_1
 
 
-        if row[0] in omit_pairs:
-            omit_pairs[row[0]] = omit_pairs[row[0]] + 1
-        if row[1] in omit_pairs:
-            omit_pairs[row[1]] = omit_pairs[row[1]] + 1
+        if row.iloc[0] in omit_pairs:
+            omit_pairs[row.iloc[0]] = omit_pairs[row.iloc[0]] + 1
+        if row.iloc[1] in omit_pairs:
+            omit_pairs[row.iloc[1]] = omit_pairs[row.iloc[1]] + 1
             
-        if row[0] not in omit_pairs:
-            omit_pairs[row[0]] = 1
-        if row[1] not in omit_pairs:
-            omit_pairs[row[1]] = 1
+        if row.iloc[0] not in omit_pairs:
+            omit_pairs[row.iloc[0]] = 1
+        if row.iloc[1] not in omit_pairs:
+            omit_pairs[row.iloc[1]] = 1
         
         if count == thresh:
             break
         
-        ranked_pair.at[index,'CCS'],ranked_pair.at[index,'MGD'] = ranked_stat(gene_1,gene_2,lead_gene,cls_counts,other_pair_tp_tn,other_sing_tp_tn,in_cls_count)
+        ranked_pair.at[index,'CCS'],ranked_pair.at[index,'MGD'] = ranked_stat(gene_1,gene_2,lead_gene,cls_counts,other_sing_tp_tn,in_cls_count)
         count = count + 1
 
     loopend = time.time()
-    ranked_pair.sort_values(by='CCS',ascending=False,inplace=True)
-    ranked_pair['CCS_rank'] = ranked_pair.reset_index().index + 1
-    ranked_pair['finalrank'] = ranked_pair[['HG_rank', 'CCS_rank']].mean(axis=1)
-    ranked_pair.sort_values(by='finalrank',ascending=True,inplace=True)
-    ranked_pair['rank'] = ranked_pair.reset_index().index + 1
-    ranked_pair.drop('finalrank',axis=1,inplace=True)
+    #CCS_rank is the position by CCS descending (NaN last), rows are then
+    #permuted once by the mean of HG_rank and CCS_rank. Ties fall back to
+    #CCS_rank, as sorting by CCS and then by finalrank would.
+    pair_count = len(ranked_pair)
+    positions = np.arange(1, pair_count + 1)
+    ccs_rank = np.empty(pair_count, dtype=int)
+    ccs_rank[np.argsort(-ranked_pair['CCS'].values, kind='stable')] = positions
+    ranked_pair['CCS_rank'] = ccs_rank
+    ranked_pair = ranked_pair.iloc[
+        np.lexsort((ccs_rank, ranked_pair['HG_rank'].values + ccs_rank))
+    ].assign(rank=positions)
     omit_genes = {}
     count = 0
     if len(ranked_pair.index) < 5000:
@@ -1027,24 +1245,24 @@ def ranker(pair,xlmhg,sing_tp_tn,other_sing_tp_tn,other_pair_tp_tn,cls_counts,in
         if count == plot_num:
             break
         #If a gene has appeared more than 10 times, dont plot anymore
-        if row[0] in omit_genes:
-            if omit_genes[row[0]] >= 10:
+        if row.iloc[0] in omit_genes:
+            if omit_genes[row.iloc[0]] >= 10:
                 ranked_pair.at[index,'Plot'] = 0
             else:
                 # test if the non-adjusted pvalue is less than .05
-                if row[2]  >= .05:
+                if row.iloc[2]  >= .05:
                     ranked_pair.at[index,'Plot'] = 0
                 else:
                     #If true positive rate is less than 15%, dont plot
-                    if row[3] <= .15:
+                    if row.iloc[3] <= .15:
                         ranked_pair.at[index,'Plot'] = 0
                     else:
                         ranked_pair.at[index,'Plot'] = 1
-                omit_genes[row[0]] = omit_genes[row[0]]+1
+                omit_genes[row.iloc[0]] = omit_genes[row.iloc[0]]+1
                 count = count + 1
         else:
-            omit_genes[row[0]] = 1
-            if row[2] >= .05:
+            omit_genes[row.iloc[0]] = 1
+            if row.iloc[2] >= .05:
                 ranked_pair.at[index,'Plot'] = 0
             else:
                 ranked_pair.at[index,'Plot'] = 1
@@ -1172,7 +1390,7 @@ def trips_hg(gene_map,in_cls_count,pop_count,trips_in_cls,trips_total,trips_indi
         else:
             pval = -math.log(ss.hypergeom.sf(in_cls_value,pop_count,in_cls_count,total_value,loc),10)
         return pval
-    vhg = np.vectorize(func, excluded = [1,2,4], otypes=[np.float])
+    vhg = np.vectorize(func, excluded = [1,2,4], otypes=[float])
     hg_result = vhg(
         trips_in_cls[trips_indices],
         pop_count,
@@ -1196,7 +1414,7 @@ def trips_hg(gene_map,in_cls_count,pop_count,trips_in_cls,trips_total,trips_indi
         trips_in_cls[trips_indices], trips_total[trips_indices]
     )
     
-    vhg = np.vectorize(ss.hypergeom.sf, excluded=[1, 2, 4], otypes=[np.float])
+    vhg = np.vectorize(ss.hypergeom.sf, excluded=[1, 2, 4], otypes=[float])
 
     
     hg_result = vhg(
@@ -1273,14 +1491,14 @@ def trips_hg(gene_map,in_cls_count,pop_count,trips_in_cls,trips_total,trips_indi
         #if row[-1] < .9:
         #    output.drop([index],inplace=True)
         #    continue
-        if row[0]==row[1] or row[1]==row[2] or row[0]==row[2]:
+        if row.iloc[0]==row.iloc[1] or row.iloc[1]==row.iloc[2] or row.iloc[0]==row.iloc[2]:
             output.drop([index],inplace=True)
             continue
-        if row[3] == prev_stat:
+        if row.iloc[3] == prev_stat:
             output.drop([index],inplace=True)
             continue
         else:
-            prev_stat = row[3]
+            prev_stat = row.iloc[3]
         counter = counter+1
             
     #print(output)
@@ -1302,7 +1520,7 @@ def trips_hg_full(gene_map, in_cls_count, pop_count,trips_in_cls,trips_total,tri
         trips_in_cls[trips_indices], trips_total[trips_indices]
     )
     
-    vhg = np.vectorize(ss.hypergeom.sf, excluded=[1, 2, 4], otypes=[np.float])
+    vhg = np.vectorize(ss.hypergeom.sf, excluded=[1, 2, 4], otypes=[float])
 
     
     hg_result = vhg(
@@ -1363,13 +1581,13 @@ def trips_hg_full(gene_map, in_cls_count, pop_count,trips_in_cls,trips_total,tri
         #row[0] = gene1
         #row[1] = gene2
         #row[2] = gene3
-        if row[0]==row[1] or row[1]==row[2] or row[0]==row[2]:
+        if row.iloc[0]==row.iloc[1] or row.iloc[1]==row.iloc[2] or row.iloc[0]==row.iloc[2]:
             output.drop([index],inplace=True)
             continue
         drop = 0
         for gene_list in used_genes:
             
-            if row[0] in gene_list and row[1] in gene_list and row[2] in gene_list:
+            if row.iloc[0] in gene_list and row.iloc[1] in gene_list and row.iloc[2] in gene_list:
                 output.drop([index],inplace=True)
                 drop = 1
                 break
@@ -1378,7 +1596,7 @@ def trips_hg_full(gene_map, in_cls_count, pop_count,trips_in_cls,trips_total,tri
             if drop == 1:
                 continue
             else:
-                used_genes.append([row[0],row[1],row[2]])
+                used_genes.append([row.iloc[0],row.iloc[1],row.iloc[2]])
         if drop == 1:
             continue
         else:
@@ -1387,3 +1605,38 @@ def trips_hg_full(gene_map, in_cls_count, pop_count,trips_in_cls,trips_total,tri
     #print(output)
     #time.sleep(1000)
     return output
+
+
+def top_k_sorted(df, col, k, ascending=True):
+    """Finds the k rows of a DataFrame with the lowest (or highest) values in
+    a column, sorted by that column.
+
+    Equivalent to df.sort_values(by=col, ascending=ascending,
+    kind='stable').head(k), but only the k selected rows are sorted; the rest
+    are split off with numpy.partition.  Ties, including those at the k-th
+    value, keep row order and NaN values go last, as with the stable sort.
+
+    :param df: The DataFrame to select rows from.
+    :param col: The column to sort by.
+    :param k: The number of rows to return.
+    :param ascending: Whether to keep the lowest (True) or highest values.
+
+    :rtype: pandas.DataFrame
+    """
+    if k >= len(df):
+        return df.sort_values(by=col, ascending=ascending, kind='stable')
+    values = df[col].values
+    if not ascending:
+        values = -values
+    if k <= 0:
+        return df.iloc[:0]
+    kth = np.partition(values, k - 1)[k - 1]
+    if np.isnan(kth):
+        #fewer than k numbers, so the first NaN rows fill the rest
+        above = np.flatnonzero(~np.isnan(values))
+        tied = np.flatnonzero(np.isnan(values))
+    else:
+        above = np.flatnonzero(values < kth)
+        tied = np.flatnonzero(values == kth)
+    top = np.sort(np.concatenate([above, tied[:k - len(above)]]))
+    return df.iloc[top[np.argsort(values[top], kind='stable')]].copy()
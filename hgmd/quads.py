@@ -42,12 +42,11 @@ def combination_product(discrete_exp,c_list,coi,trips_list):
     if trips_list == None:
         pass
     else:
-        for column in discrete_exp:
-            #print(column)
-            if str(column) in trips_list:
-                continue
-            else:
-                discrete_exp.drop(column, axis=1,inplace=True)
+        keep = set(trips_list)
+        discrete_exp.drop(
+            [column for column in discrete_exp if str(column) not in keep],
+            axis=1, inplace=True
+        )
     ################
     
     
@@ -112,7 +111,7 @@ def quads_hg(gene_map,in_cls_count,pop_count,quads_in_cls,quads_total,quads_indi
         quads_in_cls[quads_indices], quads_total[quads_indices]
     )
     
-    vhg = np.vectorize(ss.hypergeom.sf, excluded=[1, 2, 4], otypes=[np.float])
+    vhg = np.vectorize(ss.hypergeom.sf, excluded=[1, 2, 4], otypes=[float])
 
     
     hg_result = vhg(
@@ -166,14 +165,14 @@ def quads_hg(gene_map,in_cls_count,pop_count,quads_in_cls,quads_total,quads_indi
         #if row[-1] < .9:
         #    output.drop([index],inplace=True)
         #    continue
-        if row[0]==row[1] or row[1]==row[2] or row[0]==row[2] or row[0]==row[3] or row[1]==row[3] or row[2]==row[3]:
+        if row.iloc[0]==row.iloc[1] or row.iloc[1]==row.iloc[2] or row.iloc[0]==row.iloc[2] or row.iloc[0]==row.iloc[3] or row.iloc[1]==row.iloc[3] or row.iloc[2]==row.iloc[3]:
             output.drop([index],inplace=True)
             continue
-        if row[3] == prev_stat:
+        if row.iloc[3] == prev_stat:
             output.drop([index],inplace=True)
             continue
         else:
-            prev_stat = row[3]
+            prev_stat = row.iloc[3]
         counter = counter+1
 
     endfilt = time.time()